@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.db import connections, models, router, transaction
+
+from .caching import bump_generation
+from .fields import get_encoder_class
+
+
+def get_pk_db_type(model, connection):
+    pk = model._meta.pk
+    if hasattr(pk, "rel_db_type"):
+        return pk.rel_db_type(connection)
+    if isinstance(pk, models.AutoField):
+        return models.IntegerField().db_type(connection)
+    return pk.db_type(connection)
+
+
+def batch_patches(patches, batch_size):
+    """Group patches of the same kind into batches touching each row at most once
+
+    An UPDATE ... FROM applies only one of the rows joined to each target row, so a row which
+    is patched again (or by a patch of another kind) starts a new batch; this keeps patches
+    applied in the order they were given
+    """
+    batch, kind, pks = [], None, set()
+    for patch in patches:
+        patch_kind = "path" if len(patch) == 3 else "doc"
+        if batch and (patch_kind != kind or patch[0] in pks or len(batch) >= batch_size):
+            yield kind, batch
+            batch, pks = [], set()
+        batch.append(patch)
+        kind = patch_kind
+        pks.add(patch[0])
+    if batch:
+        yield kind, batch
+
+
+def bulk_patch(model, field_name, patches, batch_size=1000, using=None):
+    """Apply many small patches to a jsonb field server-side, without sending whole documents
+
+    Patches are either (pk, path, value) tuples, which set the value at a path (a list of
+    keys) with jsonb_set, or (pk, partial_doc) tuples, which merge the top-level keys of
+    partial_doc into the document with ||. They're sent in batches of UPDATE ... FROM
+    (VALUES ...) statements within a transaction. Like QuerySet.update, no signals are sent,
+    but results cached by djsonb.caching are invalidated.
+    jsonb_set only creates the last key of a path, so its parents must already exist.
+    Requires PostgreSQL >= 9.5. Returns the number of rows updated.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    table = qn(opts.db_table)
+    column = qn(opts.get_field(field_name).column)
+    pk_type = get_pk_db_type(model, connection)
+    encoder = get_encoder_class()
+
+    templates = {
+        "path": ("jsonb_set(COALESCE({table}.{column}, '{{}}'), patch.path, patch.value)",
+                 "(%s::{pk_type}, %s::text[], %s::jsonb)", "patch(pk, path, value)"),
+        "doc": ("COALESCE({table}.{column}, '{{}}') || patch.doc",
+                "(%s::{pk_type}, %s::jsonb)", "patch(pk, doc)"),
+    }
+
+    updated = 0
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        for kind, batch in batch_patches(patches, batch_size):
+            expression, row, alias = templates[kind]
+            params = []
+            for patch in batch:
+                if kind == "path":
+                    params += [patch[0], ["%s" % key for key in patch[1]],
+                               json.dumps(patch[2], cls=encoder)]
+                else:
+                    params += [patch[0], json.dumps(patch[1], cls=encoder)]
+            sql = ("UPDATE {table} SET {column} = {expression} FROM (VALUES {rows}) AS {alias} "
+                   "WHERE {table}.{pk} = patch.pk").format(
+                table=table, column=column, alias=alias, pk=qn(opts.pk.column),
+                expression=expression.format(table=table, column=column),
+                rows=", ".join([row.format(pk_type=pk_type)] * len(batch)))
+            cursor.execute(sql, params)
+            updated += cursor.rowcount
+    bump_generation(model, using=using)
+    return updated
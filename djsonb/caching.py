@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import models, transaction
+from django.db.models.signals import class_prepared, post_delete, post_save
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[getattr(settings, "DJSONB_CACHE_ALIAS", "default")]
+
+
+def get_cache_timeout():
+    return getattr(settings, "DJSONB_CACHE_TIMEOUT", 300)
+
+
+def cache_stats():
+    """Report the hits and misses of the result cache since the process started"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def _record(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def model_label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.model_name)
+
+
+def generation_key(model):
+    return "djsonb:generation:%s" % model_label(model)
+
+
+def get_generation(model):
+    """Return the model's current generation, which every cached result is keyed by"""
+    cache = get_cache()
+    key = generation_key(model)
+    generation = cache.get(key)
+    if generation is None:
+        # Start from the clock so that a generation which was evicted can't come back around
+        cache.add(key, int(time.time() * 1000), None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generation(model, using=None):
+    """Invalidate every cached result for a model
+
+    The generation is bumped again once the current transaction commits, so that results
+    cached by other connections before the changes became visible to them are dropped too
+    """
+    def bump():
+        cache = get_cache()
+        try:
+            cache.incr(generation_key(model))
+        except ValueError:
+            get_generation(model)
+
+    bump()
+    if hasattr(transaction, "on_commit"):
+        transaction.on_commit(bump, using=using)
+
+
+def _invalidate(sender, instance, using=None, **kwargs):
+    bump_generation(sender, using=using)
+
+
+def register(model):
+    """Bump a model's generation whenever one of its instances is saved or deleted
+
+    This has to happen in every process which writes to the model, not just in those reading
+    cached results, so it's done when the model is defined: models with a manager built by
+    InvalidatingQuerySet.as_manager() are registered automatically, others should be
+    registered from an AppConfig's ready(). Bulk changes don't send signals; InvalidatingQuerySet
+    covers QuerySet.update and bulk_create as well
+    """
+    uid = "djsonb_cache_%s" % model_label(model)
+    post_save.connect(_invalidate, sender=model, dispatch_uid=uid)
+    post_delete.connect(_invalidate, sender=model, dispatch_uid=uid)
+
+
+class InvalidatingQuerySet(models.QuerySet):
+    """A QuerySet whose bulk changes invalidate the cached results for its model"""
+    def update(self, **kwargs):
+        rows = super(InvalidatingQuerySet, self).update(**kwargs)
+        bump_generation(self.model, using=self.db)
+        return rows
+    update.alters_data = True
+
+    def bulk_create(self, *args, **kwargs):
+        objs = super(InvalidatingQuerySet, self).bulk_create(*args, **kwargs)
+        bump_generation(self.model, using=self.db)
+        return objs
+
+    def as_manager(cls):
+        manager = InvalidatingManager.from_queryset(cls)()
+        manager._built_with_as_manager = True
+        return manager
+    as_manager.queryset_only = True
+    as_manager = classmethod(as_manager)
+
+
+class InvalidatingManager(models.Manager):
+    """A manager whose models get registered as they are defined"""
+    pass
+
+
+def _register_managed(sender, **kwargs):
+    if any(isinstance(manager, InvalidatingManager) for manager in sender._meta.managers):
+        register(sender)
+
+
+class_prepared.connect(_register_managed, dispatch_uid="djsonb_cache_class_prepared")
+
+
+def result_key(queryset, kind):
+    """Key a result by the model's generation and a hash of the queryset's compiled SQL
+
+    FilterTree compiles equivalent filter trees to identical SQL, so this is a canonical key
+    for the filter tree (and the rest of the queryset) as well
+    """
+    sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    digest = hashlib.sha1(("%s|%r" % (sql, params)).encode("utf-8")).hexdigest()
+    return "djsonb:%s:%s:%s:%s:%s" % (kind, model_label(queryset.model),
+                                      get_generation(queryset.model), queryset.db, digest)
+
+
+def _cached(queryset, kind, compute, timeout, empty):
+    try:
+        key = result_key(queryset, kind)
+    except EmptyResultSet:
+        # Querysets which can't match anything (like .none()) aren't worth caching
+        return empty
+    cache = get_cache()
+    result = cache.get(key)
+    if result is not None:
+        _record("hits")
+        return result
+    _record("misses")
+    result = compute()
+    cache.set(key, result, get_cache_timeout() if timeout is None else timeout)
+    return result
+
+
+def cached_ids(queryset, timeout=None):
+    """Return the pks matched by a queryset, from the cache when it has been seen before"""
+    return _cached(queryset, "ids", lambda: list(queryset.values_list("pk", flat=True)),
+                   timeout, [])
+
+
+def cached_count(queryset, timeout=None):
+    """Return the number of rows matched by a queryset, from the cache when it has been seen
+    before"""
+    return _cached(queryset.order_by(), "count", queryset.count, timeout, 0)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.conf import settings
+from django.db import connections
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+
+def get_approximate_count_threshold():
+    return getattr(settings, "DJSONB_APPROXIMATE_COUNT_THRESHOLD", 1000)
+
+
+def estimate_count(queryset):
+    """Return the planner's estimate of the number of rows a queryset will produce"""
+    connection = connections[queryset.db]
+    try:
+        sql, params = queryset.order_by().query.get_compiler(using=queryset.db).as_sql()
+    except EmptyResultSet:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    # Depending on the typecasters in use the plan may or may not have been decoded already
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def approximate_count(queryset, threshold=None):
+    """Count a queryset cheaply, trading accuracy for speed on large result sets
+
+    The planner's row estimate for the queryset's SQL (jsonb filters included) is used as long
+    as it is at least `threshold`, which defaults to the DJSONB_APPROXIMATE_COUNT_THRESHOLD
+    setting. Smaller results are counted exactly, since the estimate is least reliable there
+    and an exact count is cheap anyway.
+    """
+    if threshold is None:
+        threshold = get_approximate_count_threshold()
+    estimate = estimate_count(queryset)
+    if estimate < threshold:
+        return queryset.count()
+    return estimate
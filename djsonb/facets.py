@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from django.db import connections
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+from .lookups import extract_value_at_path
+
+
+def facet_counts(queryset, field_name, paths, limit=None):
+    """Count the distinct values found at several json paths of a (filtered) queryset
+
+    All of the paths are counted in a single scan of the queryset: each row is fanned out
+    into one (facet, value) pair per path by a lateral VALUES list and the pairs are grouped
+    together. If `limit` is provided only the `limit` most frequent values of each path are
+    returned.
+
+    Paths are lists of keys, like those FilterTree rules are found at; values come back as
+    text, the way `extract_value_at_path` extracts them, and rows which lack a path are
+    counted under None. The result maps each path (as a tuple) to a list of (value, count)
+    pairs, most frequent first:
+    facet_counts(Something.objects.filter(data__jsonb=filt), 'data', [['a', 'b']])
+    => {('a', 'b'): [('zog', 2), ('dog', 1)]}
+    """
+    paths = [list(path) for path in paths]
+    results = dict((tuple(path), []) for path in paths)
+    if not paths:
+        return results
+
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    column = queryset.model._meta.get_field(field_name).column
+
+    try:
+        inner_sql, inner_params = (queryset.order_by().values(field_name).query
+                                   .get_compiler(using=queryset.db).as_sql())
+    except EmptyResultSet:
+        return results
+
+    facet_rows = []
+    facet_params = []
+    for index, path in enumerate(paths):
+        facet_rows.append('({index}, {value})'.format(
+            index=index,
+            value=extract_value_at_path(['filtered.' + qn(column)] + path)))
+        facet_params += path
+
+    grouped = ('SELECT facet.idx, facet.value, count(*) AS total, '
+               'row_number() OVER (PARTITION BY facet.idx '
+               'ORDER BY count(*) DESC, facet.value) AS rank '
+               'FROM ({inner}) AS filtered '
+               'CROSS JOIN LATERAL (VALUES {rows}) AS facet(idx, value) '
+               'GROUP BY facet.idx, facet.value'
+               .format(inner=inner_sql, rows=', '.join(facet_rows)))
+    params = list(inner_params) + facet_params
+
+    sql = 'SELECT idx, value, total FROM ({grouped}) AS counted'.format(grouped=grouped)
+    if limit is not None:
+        sql += ' WHERE rank <= %s'
+        params.append(limit)
+    sql += ' ORDER BY idx, rank'
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for index, value, total in cursor.fetchall():
+            results[tuple(paths[index])].append((value, total))
+    return results
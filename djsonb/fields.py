@@ -5,12 +5,12 @@ import django
 import copy
 
 import psycopg2
-import psycopg2.extensions
 import psycopg2.extras
 
 from django import forms
 from django.db import models
 from django.db.backends.postgresql_psycopg2.version import get_version
+from django.db.backends.signals import connection_created
 from django.conf import settings
 from django.utils import six
 
@@ -26,17 +26,92 @@ def get_encoder_class():
     return import_string(encoder_cls_path)
 
 
+def get_decoder_function(alias):
+    decoder_paths = getattr(settings, "DJSONB_DECODER_FUNCTIONS", {})
+    return import_string(decoder_paths.get(alias, "json.loads"))
+
+
 class JsonAdapter(psycopg2.extras.Json):
+    separators = None
+
     def dumps(self, obj):
-        return json.dumps(obj, cls=get_encoder_class())
+        return json.dumps(obj, cls=get_encoder_class(), separators=self.separators)
+
+
+class CompactJsonAdapter(JsonAdapter):
+    separators = (",", ":")
 
 
-psycopg2.extensions.register_adapter(dict, JsonAdapter)
-psycopg2.extras.register_default_json(loads=json.loads)
+def same_json(a, b):
+    """Compare values as their JSON encodings, which (unlike ==) tell 1 from true and 0.0 from 0"""
+    encoder = get_encoder_class()
+    return json.dumps(a, cls=encoder, sort_keys=True) == json.dumps(b, cls=encoder, sort_keys=True)
 
-# so that psycopg2 knows also to convert jsonb fields correctly
-# http://schinckel.net/2014/05/24/python,-postgres-and-jsonb/
-psycopg2.extras.register_json(loads=json.loads, oid=3802, array_oid=3807)
+
+def strip_document(value, defaults=None, strip_nulls=True):
+    """Drop the null values, and the values equal to their declared defaults, from a document
+
+    Lists are kept as they are (so indexes don't shift), but objects within them are stripped
+    """
+    if isinstance(value, list):
+        return [strip_document(item, None, strip_nulls) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if not isinstance(defaults, dict):
+        defaults = {}
+    stripped = {}
+    for key, item in value.items():
+        # A null where a default is declared has to be kept, or it would read back as the default
+        if item is None and strip_nulls and key not in defaults:
+            continue
+        if (key in defaults and not isinstance(defaults[key], dict) and
+                same_json(item, defaults[key])):
+            continue
+        stripped[key] = strip_document(item, defaults.get(key), strip_nulls)
+        if isinstance(defaults.get(key), dict) and stripped[key] == {}:
+            del stripped[key]
+    return stripped
+
+
+def restore_defaults(value, defaults):
+    """Fill in the declared defaults missing from a copy of a document"""
+    if not isinstance(value, dict) or not isinstance(defaults, dict):
+        return value
+    restored = copy.copy(value)
+    for key, default in defaults.items():
+        if key not in restored:
+            restored[key] = copy.deepcopy(default)
+        else:
+            restored[key] = restore_defaults(restored[key], default)
+    return restored
+
+
+def get_server_version(connection):
+    """Return the server version of a Django connection, querying it at most once"""
+    version = getattr(connection, "_djsonb_server_version", None)
+    if version is None:
+        version = get_version(connection)
+        connection._djsonb_server_version = version
+    return version
+
+
+def setup_connection(sender, connection, **kwargs):
+    """Register the json and jsonb typecasters on each new connection
+
+    Each database alias can be given its own decoder by DJSONB_DECODER_FUNCTIONS, a dict of
+    alias to dotted path of a `loads` function. The server version is cached on the way.
+    """
+    if connection.vendor != "postgresql":
+        return
+    loads = get_decoder_function(connection.alias)
+    psycopg2.extras.register_default_json(connection.connection, loads=loads)
+    # so that psycopg2 knows also to convert jsonb fields correctly
+    # http://schinckel.net/2014/05/24/python,-postgres-and-jsonb/
+    psycopg2.extras.register_json(connection.connection, loads=loads, oid=3802, array_oid=3807)
+    connection._djsonb_server_version = connection.connection.server_version
+
+
+connection_created.connect(setup_connection, dispatch_uid="djsonb_setup_connection")
 
 if django.VERSION < (1, 8):
     base_field_class = six.with_metaclass(models.SubfieldBase, models.Field)
@@ -51,7 +126,7 @@ class JsonField(base_field_class):
         super(JsonField, self).__init__(*args, **kwargs)
 
     def db_type(self, connection):
-        if get_version(connection) < 90200:
+        if get_server_version(connection) < 90200:
             raise RuntimeError("djsonb does not supports postgresql version < 9.2")
         return "json"
 
@@ -93,11 +168,52 @@ class JsonField(base_field_class):
 
 
 class JsonBField(JsonField):
+    """A jsonb column
+
+    Hot paths can be materialized into typed shadow columns, which `__jsonb` filters on those
+    paths will then read instead of traversing the json:
+    JsonBField(shadow_columns={'data_status': {'path': ['status'], 'type': 'text'}})
+    The columns themselves are created and kept up to date by the AddShadowColumn migration
+    operation in djsonb.operations.
+
+    Paths which are mirrored into the partition key of a partitioned table can be declared
+    the same way, as `partition_columns`. Filters on them keep traversing the json, but also
+    get an equivalent predicate on the partition key so that partitions can be pruned. Those
+    columns are regular model fields, populated by the application.
+
+    Documents can be stored compactly: `compact=True` strips null values (but not those of
+    keys with a declared default) and whitespace, and `implicit_defaults` (a dict, nested like
+    the documents) strips the values which equal their declared defaults. Defaults are
+    restored as documents are read, so keys which are absent from a document read back as
+    their defaults. Filters run against the stored
+    documents though, and so won't find values that were stripped.
+    """
+    def __init__(self, *args, **kwargs):
+        self.shadow_columns = kwargs.pop("shadow_columns", {})
+        self.partition_columns = kwargs.pop("partition_columns", {})
+        self.compact = kwargs.pop("compact", False)
+        self.implicit_defaults = kwargs.pop("implicit_defaults", None)
+        super(JsonBField, self).__init__(*args, **kwargs)
+
     def db_type(self, connection):
-        if get_version(connection) < 90400:
+        if get_server_version(connection) < 90400:
             raise RuntimeError("djsonb: PostgreSQL >= 9.4 is required for jsonb support.")
         return "jsonb"
 
+    def from_db_value(self, value, expression, connection, context):
+        return restore_defaults(value, self.implicit_defaults)
+
+    def to_python(self, value):
+        return restore_defaults(super(JsonBField, self).to_python(value), self.implicit_defaults)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = super(JsonBField, self).get_db_prep_value(value, connection, prepared=prepared)
+        if isinstance(value, JsonAdapter) and (self.compact or self.implicit_defaults):
+            adapter_class = CompactJsonAdapter if self.compact else JsonAdapter
+            value = adapter_class(strip_document(value.adapted, self.implicit_defaults,
+                                                 strip_nulls=self.compact))
+        return value
+
     def get_prep_lookup(self, lookup_type, value, prepared=False):
         """ Cleanup value for the jsonb lookup types
 
@@ -123,6 +239,18 @@ class JsonBField(JsonField):
                 raise TypeError("jhas lookup requires str or int")
         return value
 
+    def deconstruct(self):
+        name, path, args, kwargs = super(JsonBField, self).deconstruct()
+        if self.shadow_columns:
+            kwargs["shadow_columns"] = self.shadow_columns
+        if self.partition_columns:
+            kwargs["partition_columns"] = self.partition_columns
+        if self.compact:
+            kwargs["compact"] = self.compact
+        if self.implicit_defaults:
+            kwargs["implicit_defaults"] = self.implicit_defaults
+        return name, path, args, kwargs
+
 if django.VERSION >= (1, 7):
     from .lookups import DriverLookup
 
@@ -3,7 +3,9 @@ import json
 import re
 import shlex
 
+from django.conf import settings
 from django.db.models import Lookup
+from django.utils import six
 
 
 class FilterTree:
@@ -14,16 +16,49 @@ class FilterTree:
     Manually filtering by way of Django's ORM might look like:
     Something.objects.filter(<jsonb_field>__jsonb=<filter_specification>)
 
-    Check out the tests for some real examples"""
-    def __init__(self, tree, field):
+    Check out the tests for some real examples
+
+    `shadow_columns` maps paths (tuples of keys below the field) to the (quoted) typed columns
+    they are materialized into, as (column, db_type) pairs. Rules at those paths are rewritten
+    to read the column rather than to traverse the json, when the column's type suits them:
+    intrange rules need a numeric column, containment rules a text one
+
+    `partition_columns` likewise maps paths to the partition key columns they are mirrored
+    into. Rules at those paths are kept, but get an equivalent predicate on the partition key
+    added alongside (when its type suits them, as for shadow columns), so that PostgreSQL can
+    prune partitions at plan time
+
+    Rules can be combined with group nodes, which apply at the location they're found at:
+    {'_any': [<tree>, <tree>]} matches when any of the trees does, {'_all': [<tree>, ...]} when
+    all of them do and {'_not': <tree>} when the tree doesn't. Each tree in a group compiles
+    just like a whole filter tree would. Like SQL's NOT, `_not` doesn't match records for
+    which an intrange rule's path is missing"""
+    def __init__(self, tree, field, shadow_columns=None, partition_columns=None):
         self.field = field
         self.tree = tree
+        self.shadow_columns = shadow_columns or {}
+        self.partition_columns = partition_columns or {}
         self.sql_generators = {
             "intrange": FilterTree.intrange_filter,
             "containment": FilterTree.containment_filter,
             "containment_multiple": FilterTree.multiple_containment_filter
         }
+        self.shadow_sql_generators = {
+            "intrange": FilterTree.shadow_intrange_filter,
+            "containment": FilterTree.shadow_containment_filter
+        }
+        # Rules are only rewritten against columns whose type compares the way the json does
+        self.shadow_column_types = {
+            "intrange": NUMERIC_COLUMN_TYPES,
+            "containment": TEXT_COLUMN_TYPES
+        }
+        self.group_operators = {
+            "_any": ' OR ',
+            "_all": ' AND ',
+            "_not": None
+        }
         self.rules = self.get_rules(self.tree)
+        self.groups = self.get_groups(self.tree)
 
     def is_rule(self, obj):
         """Check for bottoming out the recursion in `get_rules`"""
@@ -42,10 +77,83 @@ class FilterTree:
             return [([self.field] + current_path, obj)]
 
         rules = []
-        for path, val in obj.items():
+        # Visit keys in order so that equivalent trees always compile to identical SQL
+        for path, val in sorted(obj.items(), key=lambda item: u'%s' % (item[0],)):
+            # Rules within groups are compiled along with their group
+            if path in self.group_operators:
+                continue
             rules = rules + self.get_rules(val, current_path + [path])
         return rules
 
+    def get_groups(self, obj, current_path=[]):
+        """Recursively crawl a dict looking for group nodes, returning their locations,
+        operators and operands"""
+        if type(obj) != dict or self.is_rule(obj):
+            return []
+
+        groups = []
+        for path, val in sorted(obj.items(), key=lambda item: u'%s' % (item[0],)):
+            if path in self.group_operators:
+                groups.append((current_path, path, val))
+            else:
+                groups = groups + self.get_groups(val, current_path + [path])
+        return groups
+
+    def subtree(self, path, subtree):
+        """Build the FilterTree of a tree found at some location, with its keys prefixed by
+        the location's"""
+        for key in reversed(path):
+            subtree = {key: subtree}
+        return FilterTree(subtree, self.field, shadow_columns=self.shadow_columns,
+                          partition_columns=self.partition_columns)
+
+    def subtree_sql(self, path, subtree):
+        """Compile a tree found at some location as though it were a whole filter tree"""
+        return self.subtree(path, subtree).sql()
+
+    def group_sql(self, path, operator, operand):
+        """Combine the trees of a group node into a single parenthesized clause
+
+        Trees which don't filter anything are left out; since they match every record, an
+        `_any` group containing one doesn't filter anything either. An `_any` group of no trees
+        at all matches no records, while an empty `_all` group matches every one"""
+        if operator == '_not':
+            if type(operand) != dict:
+                raise TypeError("djsonb: _not requires a filter tree")
+            sql_string, sql_params = self.subtree_sql(path, operand)
+            if sql_string == '':
+                return None
+            return ('(NOT ' + sql_string + ')', sql_params)
+
+        if type(operand) != list:
+            raise TypeError("djsonb: {op} requires a list of filter trees".format(op=operator))
+        if operator == '_any' and not operand:
+            return ('(FALSE)', [])
+        branches = [self.subtree_sql(path, subtree) for subtree in operand]
+        if operator == '_any' and any(branch[0] == '' for branch in branches):
+            return None
+        branches = [branch for branch in branches if branch[0] != '']
+        if not branches:
+            return None
+        sql_string = self.group_operators[operator].join([branch[0] for branch in branches])
+        return ('(' + sql_string + ')', [param for branch in branches for param in branch[1]])
+
+    def column_fits(self, column, rule_type):
+        """Check that a rule can be applied to a (column, db_type) pair instead of the json"""
+        if column is None or rule_type not in self.shadow_sql_generators:
+            return False
+        return base_db_type(column[1]) in self.shadow_column_types[rule_type]
+
+    def get_shadow_column(self, path, rule_type):
+        """Find the shadow column a rule can be rewritten against, if there is one"""
+        column = self.shadow_columns.get(tuple(path[1:]))
+        return column if self.column_fits(column, rule_type) else None
+
+    def get_partition_column(self, path, rule_type):
+        """Find the partition key column a rule can be mirrored onto, if there is one"""
+        column = self.partition_columns.get(tuple(path[1:]))
+        return column if self.column_fits(column, rule_type) else None
+
     def sql(self):
         """Produce output that can be compiled into SQL by Django and psycopg2.
 
@@ -62,15 +170,28 @@ class FilterTree:
             if not self.is_rule(rule[1]):
                 pass
             rule_type = rule[1]['_rule_type']
-            sql_tuple = self.sql_generators[rule_type](rule[0], rule[1])
+            shadow_column = self.get_shadow_column(rule[0], rule_type)
+            if shadow_column is not None:
+                sql_tuple = self.shadow_sql_generators[rule_type](shadow_column, rule[1])
+            else:
+                sql_tuple = self.sql_generators[rule_type](rule[0], rule[1])
             if sql_tuple is not None:
                 rule_specs.append(sql_tuple)
 
+            partition_column = self.get_partition_column(rule[0], rule_type)
+            if partition_column is not None:
+                sql_tuple = self.shadow_sql_generators[rule_type](partition_column, rule[1])
+                if sql_tuple is not None:
+                    rule_specs.append(sql_tuple)
+
             # The check on 'pattern' here allows us to apply a pattern filter on top of others
             if 'pattern' in rule[1]:
                 # Don't filter as an exact match on the text entered; match per word.
                 for pattern in shlex.split(rule[1]['pattern']):
-                    if rule[1]['_rule_type'] == 'containment_multiple':
+                    if shadow_column is not None:
+                        sql_tuple = FilterTree.shadow_text_similarity_filter(shadow_column,
+                                                                             pattern)
+                    elif rule[1]['_rule_type'] == 'containment_multiple':
                         sql_tuple = FilterTree.text_similarity_filter(rule[0], pattern, True)
                     else:
                         sql_tuple = FilterTree.text_similarity_filter(rule[0], pattern, False)
@@ -103,6 +224,15 @@ class FilterTree:
         rule_paths = [item for sublist in rule_paths_first
                       for item in sublist]
 
+        # groups each compile to a single clause, which has to hold alongside the other rules
+        group_specs = [spec for spec in [self.group_sql(*group) for group in self.groups]
+                       if spec is not None]
+        if group_specs:
+            filter_strings = [filter_string] if filter_string != '' else []
+            filter_string = ('(' + ' AND '.join(filter_strings + [spec[0] for spec in group_specs])
+                             + ')')
+            rule_paths += [param for spec in group_specs for param in spec[1]]
+
         outcome = (filter_string, tuple(rule_paths))
         return outcome
 
@@ -112,7 +242,6 @@ class FilterTree:
         """Filter for objects that contain the specified value at some location"""
         template = reconstruct_object(path[1:])
         has_containment = 'contains' in rule
-        abstract_contains_str = path[0] + " @> %s"
 
         if has_containment:
             all_contained = rule.get('contains')
@@ -125,12 +254,23 @@ class FilterTree:
             interpolants = tuple(json_path + [json.dumps(contained)])
             contains_params.append(template % interpolants)
 
-        contains_str = ' OR '.join([abstract_contains_str] * len(all_contained))
+        return FilterTree.any_containment_sql(path[0], contains_params)
 
-        if contains_str != '':
-            return ('(' + contains_str + ')', contains_params)
-        else:
+    @classmethod
+    def any_containment_sql(cls, field, contains_params):
+        """Combine checks that a field contains any one of several objects into one clause
+
+        Past DJSONB_CONTAINMENT_ARRAY_THRESHOLD objects, they're passed as a single array
+        parameter (matched with @> ANY) rather than as a parameter per OR'd @>, which keeps
+        very long lists cheap to send and to plan. The array is typed text[] before it's cast
+        to jsonb[], since psycopg2 sends lists as text[] and text only casts to jsonb
+        explicitly, which a prepared statement's parameters don't get"""
+        if not contains_params:
             return None
+        if len(contains_params) > get_containment_array_threshold():
+            return ('(' + field + ' @> ANY(%s::text[]::jsonb[]))', [contains_params])
+        contains_str = ' OR '.join([field + ' @> %s'] * len(contains_params))
+        return ('(' + contains_str + ')', contains_params)
 
     @classmethod
     def multiple_containment_filter(cls, path, rule):
@@ -138,7 +278,6 @@ class FilterTree:
         given list"""
         template = reconstruct_object_multiple(path[1:])
         has_containment = 'contains' in rule
-        abstract_contains_str = path[0] + " @> %s"
 
         if has_containment:
             all_contained = rule.get('contains')
@@ -151,12 +290,7 @@ class FilterTree:
             interpolants = tuple(json_path + [json.dumps(contained)])
             contains_params.append(template % interpolants)
 
-        contains_str = ' OR '.join([abstract_contains_str] * len(all_contained))
-
-        if contains_str != '':
-            return ('(' + contains_str + ')', contains_params)
-        else:
-            return None
+        return FilterTree.any_containment_sql(path[0], contains_params)
 
     @classmethod
     def intrange_filter(cls, path, rule):
@@ -215,7 +349,60 @@ class FilterTree:
             return (sql_template, path[1:] + [re.escape(pattern)])
 
 
+    @classmethod
+    def shadow_containment_filter(cls, shadow_column, rule):
+        """Filter for objects whose (text) shadow or partition key column holds one of the
+        specified values
+
+        Values are compared the way ->> would extract them from the json, so numbers and
+        booleans match by their json text"""
+        column, db_type = shadow_column
+        if not rule.get('contains'):
+            return None
+        values = [value if isinstance(value, six.string_types) else json.dumps(value)
+                  for value in rule['contains']]
+        return ('({column} = ANY(%s::{db_type}[]))'.format(column=column, db_type=db_type),
+                [values])
+
+    @classmethod
+    def shadow_intrange_filter(cls, shadow_column, rule):
+        """Filter for shadow (or partition key) column values within the boundaries provided
+        by a rule"""
+        column, db_type = shadow_column
+        bounds = []
+        params = []
+        if 'max' in rule and rule['max'] is not None:
+            bounds.append('{column} <= %s'.format(column=column))
+            params.append(rule['max'])
+        if 'min' in rule and rule['min'] is not None:
+            bounds.append('{column} >= %s'.format(column=column))
+            params.append(rule['min'])
+        if not bounds:
+            return None
+        return ('(' + ' AND '.join(bounds) + ')', params)
+
+    @classmethod
+    def shadow_text_similarity_filter(cls, shadow_column, pattern):
+        """Filter for objects whose shadow column matches against a provided pattern"""
+        column, db_type = shadow_column
+        return ('{column}::text ~* %s'.format(column=column), [re.escape(pattern)])
+
+
 # Utility functions
+NUMERIC_COLUMN_TYPES = ("smallint", "int", "integer", "bigint", "int2", "int4", "int8", "numeric",
+                        "decimal", "real", "float", "float4", "float8", "double precision")
+TEXT_COLUMN_TYPES = ("text", "varchar", "character varying")
+
+
+def base_db_type(db_type):
+    """Strip the modifiers from a column type, like varchar(30) => varchar"""
+    return db_type.split("(")[0].strip().lower()
+
+
+def get_containment_array_threshold():
+    return getattr(settings, "DJSONB_CONTAINMENT_ARRAY_THRESHOLD", 100)
+
+
 def extract_value_at_path(path):
     return operator_at_traversal_path(path, '->>')
 
@@ -239,6 +426,19 @@ def operator_at_traversal_path(path, op):
     return traversal
 
 
+def literal_value_at_path(path):
+    """Like extract_value_at_path, but with the keys of the path inlined as SQL literals
+
+    Only useful where parameters can't be used, as in the expressions of DDL statements
+    """
+    return extract_value_at_path(path) % tuple(quote_literal(key) for key in path[1:])
+
+
+def quote_literal(value):
+    """Quote a value as a SQL string literal (standard_conforming_strings is assumed)"""
+    return "'" + ('%s' % value).replace("'", "''") + "'"
+
+
 def reconstruct_object(path):
     """Reconstruct the object from root to leaf, recursively"""
     if len(path) == 0:
@@ -270,4 +470,18 @@ class DriverLookup(Lookup):
         lhs, lhs_params = self.process_lhs(qn, connection)
         rhs, rhs_params = self.process_rhs(qn, connection)
 
-        return FilterTree(rhs_params[0], lhs).sql()
+        return FilterTree(rhs_params[0], lhs,
+                          shadow_columns=self.get_path_columns(connection, 'shadow_columns'),
+                          partition_columns=self.get_path_columns(connection,
+                                                                  'partition_columns')).sql()
+
+    def get_path_columns(self, connection, attname):
+        """Map the paths a field mirrors into columns (its `shadow_columns` or
+        `partition_columns`) to those (quoted) columns and their types"""
+        alias = getattr(self.lhs, 'alias', None)
+        path_columns = getattr(self.lhs.output_field, attname, None)
+        if alias is None or not path_columns:
+            return {}
+        qn = connection.ops.quote_name
+        return dict((tuple(spec['path']), (qn(alias) + '.' + qn(column), spec['type']))
+                    for column, spec in path_columns.items())
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+
+from djsonb.fields import get_server_version
+
+# Draws the sample once, in the documents CTE (which is materialized since it's read twice),
+# so that the sizes and the paths are both counted over the same documents. Each row holds the
+# size statistics along with one (path, type) of the sampled documents, walked down to max_depth
+PROFILE_SQL = """
+WITH RECURSIVE documents AS (
+    SELECT {column} AS doc, pg_column_size({column}) AS size FROM {table} {sample}
+), sizes AS (
+    SELECT count(*), avg(size), percentile_cont(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP (ORDER BY size),
+           max(size)
+    FROM documents
+), entries(path, value, depth) AS (
+    SELECT ARRAY[entry.key], entry.value, 1
+    FROM documents,
+         jsonb_each(CASE WHEN jsonb_typeof(doc) = 'object' THEN doc ELSE '{{}}' END) AS entry
+  UNION ALL
+    SELECT entries.path || entry.key, entry.value, entries.depth + 1
+    FROM entries,
+         jsonb_each(CASE WHEN jsonb_typeof(entries.value) = 'object' THEN entries.value
+                         ELSE '{{}}' END) AS entry
+    WHERE entries.depth < %s
+), paths AS (
+    SELECT path, jsonb_typeof(value), count(*), sum(pg_column_size(value))
+    FROM entries
+    GROUP BY path, jsonb_typeof(value)
+)
+SELECT sizes.*, paths.* FROM sizes LEFT JOIN paths ON true
+"""
+
+
+class Command(BaseCommand):
+    help = ("Profile the documents of a JsonBField: their size on disk, and the frequency, "
+            "depth, type and size of the values at each path")
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="app_label.ModelName")
+        parser.add_argument("field", help="name of the JsonBField")
+        parser.add_argument("--sample", type=float, default=100,
+                            help="percentage of the table to sample (default: all of it)")
+        parser.add_argument("--max-depth", type=int, default=3,
+                            help="how deep to descend into nested objects (default: 3)")
+        parser.add_argument("--limit", type=int, default=50,
+                            help="how many of the most frequent paths to report (default: 50)")
+
+    def get_sample_sql(self, connection, percent):
+        """Sample blocks with TABLESAMPLE where it's available (PostgreSQL >= 9.5), and rows
+        at random otherwise"""
+        if percent >= 100:
+            return "", []
+        if get_server_version(connection) >= 90500:
+            return "TABLESAMPLE SYSTEM (%s)", [percent]
+        return "WHERE random() < %s", [percent / 100.0]
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options["model"])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not 0 < options["sample"] <= 100:
+            raise CommandError("--sample must be a percentage above 0")
+
+        connection = connections[router.db_for_read(model)]
+        qn = connection.ops.quote_name
+        sample, sample_params = self.get_sample_sql(connection, options["sample"])
+        names = {
+            "table": qn(model._meta.db_table),
+            "column": qn(model._meta.get_field(options["field"]).column),
+            "sample": sample,
+        }
+
+        with connection.cursor() as cursor:
+            cursor.execute(PROFILE_SQL.format(**names), sample_params + [options["max_depth"]])
+            rows = cursor.fetchall()
+        documents, average, percentiles, largest = rows[0][:4]
+        rows = [row[4:] for row in rows if row[4] is not None]
+
+        self.stdout.write("Sampled documents: %d" % documents)
+        if not documents:
+            return
+        self.stdout.write("Size in bytes (as stored): avg %d, p50 %d, p90 %d, p99 %d, max %d" % (
+            average, percentiles[0], percentiles[1], percentiles[2], largest))
+
+        paths = OrderedDict()
+        for path, json_type, count, size in sorted(rows, key=lambda row: -row[2]):
+            stats = paths.setdefault(tuple(path), {"count": 0, "size": 0, "types": OrderedDict()})
+            stats["count"] += count
+            stats["size"] += size
+            stats["types"][json_type] = count
+
+        self.stdout.write("")
+        self.stdout.write("%-40s %5s %9s %7s %10s  %s" % ("Path", "Depth", "Count", "Docs %",
+                                                         "Avg bytes", "Types"))
+        ranked = sorted(paths.items(), key=lambda item: (-item[1]["count"], item[0]))
+        for path, stats in ranked[:options["limit"]]:
+            self.stdout.write("%-40s %5d %9d %7.1f %10.1f  %s" % (
+                ".".join(path), len(path), stats["count"],
+                100.0 * stats["count"] / documents, float(stats["size"]) / stats["count"],
+                ", ".join("%s %d" % item for item in stats["types"].items())))
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import json
+from collections import Counter
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+
+from djsonb.fields import get_server_version
+from djsonb.lookups import FilterTree
+from djsonb.operations import path_statistics_name, path_statistics_sql
+
+
+def parse_path_spec(spec):
+    """Parse a path given as dot-separated keys, optionally followed by a type: a.b:int"""
+    path, _, db_type = spec.partition(":")
+    return {"path": path.split("."), "type": db_type or "text"}
+
+
+def tree_rules(tree):
+    """Produce the rules of a FilterTree, along with those within its _any/_all/_not groups"""
+    rules = list(tree.rules)
+    for path, operator, operand in tree.groups:
+        subtrees = operand if type(operand) == list else [operand]
+        for subtree in subtrees:
+            if type(subtree) == dict:
+                rules += tree_rules(tree.subtree(path, subtree))
+    return rules
+
+
+def filter_path_specs(filters):
+    """Count the path expressions which rules in a list of filter trees compare against
+
+    Intrange rules compare ::int values and patterns match text; plain containment is
+    answered by @>, which these statistics don't help with
+    """
+    counts = Counter()
+    for tree in filters:
+        for path, rule in tree_rules(FilterTree(tree, None)):
+            if rule["_rule_type"] == "intrange":
+                counts[(tuple(path[1:]), "int")] += 1
+            if "pattern" in rule and rule["_rule_type"] != "containment_multiple":
+                counts[(tuple(path[1:]), "text")] += 1
+    return counts
+
+
+class Command(BaseCommand):
+    help = ("Create statistics on the json path expressions filters use, so that the planner "
+            "can estimate their selectivity")
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="app_label.ModelName")
+        parser.add_argument("field", help="name of the JsonBField")
+        parser.add_argument("--path", action="append", dest="paths", default=[],
+                            help="dot-separated keys of a path, optionally followed by a cast "
+                                 "(like a.b:int); may be given several times. See the README "
+                                 "before casting")
+        parser.add_argument("--from-filters", dest="filters_file",
+                            help="JSON file holding a list of filter trees to take paths from; "
+                                 "these get text statistics, never a cast")
+        parser.add_argument("--top", type=int, default=10,
+                            help="how many of the paths most used by --from-filters to take")
+        parser.add_argument("--name", help="name of the statistics object")
+        parser.add_argument("--use-indexes", action="store_true",
+                            help="before PostgreSQL 14, create an expression index per path "
+                                 "to gather statistics on")
+        parser.add_argument("--drop", action="store_true",
+                            help="drop the statistics instead of creating them")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="print the SQL rather than running it")
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options["model"])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        specs = [parse_path_spec(spec) for spec in options["paths"]]
+        if options["filters_file"]:
+            with open(options["filters_file"]) as f:
+                filters = json.load(f)
+            for (path, db_type), count in filter_path_specs(filters).most_common(options["top"]):
+                if any(spec["path"] == list(path) for spec in specs):
+                    continue
+                # Casting could make ANALYZE fail, so that's left for --path to ask for
+                if db_type != "text":
+                    self.stdout.write("Gathering text statistics on %s; if every value there "
+                                      "is an %s, use --path %s:%s to match intrange rules" % (
+                                          ".".join(path), db_type, ".".join(path), db_type))
+                specs.append({"path": list(path), "type": "text"})
+        if not specs:
+            raise CommandError("No paths given; use --path or --from-filters")
+
+        connection = connections[router.db_for_write(model)]
+        name = options["name"] or path_statistics_name(model, options["field"], specs)
+        create, drop = path_statistics_sql(model, options["field"], specs, name,
+                                           get_server_version(connection),
+                                           connection.ops.quote_name, options["use_indexes"])
+        if not create:
+            raise CommandError("PostgreSQL < 14 only gathers statistics on indexed expressions; "
+                               "use --use-indexes to create expression indexes")
+        statements = drop if options["drop"] else create
+        if options["dry_run"]:
+            for sql in statements:
+                self.stdout.write(sql + ";")
+            return
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+        self.stdout.write("%s statistics %s on %d paths of %s.%s" % (
+            "Dropped" if options["drop"] else "Created", name, len(specs),
+            options["model"], options["field"]))
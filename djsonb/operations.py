@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+
+from django.db.backends.utils import truncate_name
+from django.db.migrations.operations.base import Operation
+
+from .fields import get_server_version
+from .lookups import literal_value_at_path
+
+
+class AddShadowColumn(Operation):
+    """Add a typed column materializing one of a JsonBField's `shadow_columns`
+
+    On PostgreSQL >= 12 this is a stored generated column. Older servers (or `use_trigger=True`,
+    which is needed for casts that aren't immutable, like ::timestamptz) get a plain column
+    kept up to date by a BEFORE INSERT OR UPDATE trigger, and existing rows are backfilled.
+    Every value written at the path has to cast cleanly to the column's type, or the write
+    fails. The shadow column should be declared on the field before this operation runs.
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name, name, column, use_trigger=None):
+        self.model_name = model_name
+        self.name = name
+        self.column = column
+        self.use_trigger = use_trigger
+
+    def deconstruct(self):
+        kwargs = {
+            "model_name": self.model_name,
+            "name": self.name,
+            "column": self.column,
+        }
+        if self.use_trigger is not None:
+            kwargs["use_trigger"] = self.use_trigger
+        return (self.__class__.__name__, [], kwargs)
+
+    def state_forwards(self, app_label, state):
+        # The shadow column lives outside of Django's model state
+        pass
+
+    def get_names(self, schema_editor, model):
+        """Produce the quoted table, column, trigger and trigger function names"""
+        qn = schema_editor.quote_name
+        table = model._meta.db_table
+        function = truncate_name("%s_%s_shadow" % (table, self.column), 63)
+        return {
+            "table": qn(table),
+            "column": qn(self.column),
+            "function": qn(function),
+            "trigger": qn(function),
+        }
+
+    def get_expression(self, schema_editor, model, prefix=""):
+        field = model._meta.get_field(self.name)
+        spec = field.shadow_columns[self.column]
+        path = [prefix + schema_editor.quote_name(field.column)] + list(spec["path"])
+        return "(" + literal_value_at_path(path) + ")::" + spec["type"], spec["type"]
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        names = self.get_names(schema_editor, model)
+        expression, db_type = self.get_expression(schema_editor, model)
+        use_trigger = self.use_trigger
+        if use_trigger is None:
+            use_trigger = get_server_version(schema_editor.connection) < 120000
+
+        if not use_trigger:
+            schema_editor.execute(
+                "ALTER TABLE {table} ADD COLUMN {column} {db_type} "
+                "GENERATED ALWAYS AS ({expression}) STORED"
+                .format(db_type=db_type, expression=expression, **names), params=None)
+            return
+
+        new_expression, _ = self.get_expression(schema_editor, model, prefix="NEW.")
+        schema_editor.execute("ALTER TABLE {table} ADD COLUMN {column} {db_type}"
+                              .format(db_type=db_type, **names), params=None)
+        schema_editor.execute(
+            "CREATE FUNCTION {function}() RETURNS trigger AS $$ "
+            "BEGIN NEW.{column} := {expression}; RETURN NEW; END "
+            "$$ LANGUAGE plpgsql"
+            .format(expression=new_expression, **names), params=None)
+        schema_editor.execute(
+            "CREATE TRIGGER {trigger} BEFORE INSERT OR UPDATE ON {table} "
+            "FOR EACH ROW EXECUTE PROCEDURE {function}()"
+            .format(**names), params=None)
+        schema_editor.execute("UPDATE {table} SET {column} = {expression}"
+                              .format(expression=expression, **names), params=None)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        names = self.get_names(schema_editor, model)
+        schema_editor.execute("DROP TRIGGER IF EXISTS {trigger} ON {table}".format(**names),
+                              params=None)
+        schema_editor.execute("DROP FUNCTION IF EXISTS {function}()".format(**names),
+                              params=None)
+        schema_editor.execute("ALTER TABLE {table} DROP COLUMN {column}".format(**names),
+                              params=None)
+
+    def describe(self):
+        return "Add shadow column %s for %s.%s" % (self.column, self.model_name, self.name)
+
+
+def path_statistics_name(model, field_name, specs):
+    digest = hashlib.md5(json.dumps([field_name, specs], sort_keys=True).encode("utf-8"))
+    return truncate_name("%s_%s_stats" % (model._meta.db_table, digest.hexdigest()[:8]), 55)
+
+
+def path_statistics_sql(model, field_name, specs, name, server_version, quote_name,
+                        use_indexes=False):
+    """Produce the statements creating (and dropping) statistics on json path expressions
+
+    Each spec is a dict with a `path` and an optional `type`, which gives the statistics the
+    same shape as the expressions filters use: intrange rules compare ::int values, patterns
+    match text (see CreatePathStatistics before casting). PostgreSQL >= 14 gets a single
+    CREATE STATISTICS over every expression. Older servers only gather statistics for the
+    expressions of indexes, so with `use_indexes` an expression index is created per path
+    instead, and without it there's nothing to do. Returns a (create statements, drop
+    statements) pair.
+    """
+    table = quote_name(model._meta.db_table)
+    column = quote_name(model._meta.get_field(field_name).column)
+    expressions = []
+    for spec in specs:
+        expression = literal_value_at_path([column] + list(spec["path"]))
+        if spec.get("type", "text") != "text":
+            expression = "(" + expression + ")::" + spec["type"]
+        expressions.append("(" + expression + ")")
+
+    if server_version >= 140000:
+        create = ["CREATE STATISTICS {name} ON {expressions} FROM {table}".format(
+            name=quote_name(name), expressions=", ".join(expressions), table=table)]
+        drop = ["DROP STATISTICS IF EXISTS {name}".format(name=quote_name(name))]
+    elif not use_indexes:
+        return [], []
+    else:
+        create, drop = [], []
+        for index, expression in enumerate(expressions):
+            index_name = quote_name("%s_%s" % (name, index))
+            create.append("CREATE INDEX {name} ON {table} ({expression})".format(
+                name=index_name, table=table, expression=expression))
+            drop.append("DROP INDEX IF EXISTS {name}".format(name=index_name))
+    create.append("ANALYZE {table}".format(table=table))
+    return create, drop
+
+
+class CreatePathStatistics(Operation):
+    """Gather planner statistics on the json path expressions that filters use
+
+    `paths` is a list of dicts with a `path` (a list of keys) and an optional `type` to cast
+    to, like 'int' for paths filtered by intrange rules:
+    CreatePathStatistics('Person', 'other_stuff', [{'path': ['age'], 'type': 'int'}])
+    A typed expression is evaluated on every row ANALYZE samples, so only cast paths whose
+    values are guaranteed to be of that type: once any document holds a value there which
+    doesn't cast, ANALYZE fails for the whole table, autovacuum's included.
+
+    Before PostgreSQL 14 this does nothing unless `use_indexes` is set, which creates an
+    expression index per path instead; see path_statistics_sql.
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name, name, paths, statistics_name=None, use_indexes=False):
+        self.model_name = model_name
+        self.name = name
+        self.paths = paths
+        self.statistics_name = statistics_name
+        self.use_indexes = use_indexes
+
+    def deconstruct(self):
+        kwargs = {
+            "model_name": self.model_name,
+            "name": self.name,
+            "paths": self.paths,
+        }
+        if self.statistics_name is not None:
+            kwargs["statistics_name"] = self.statistics_name
+        if self.use_indexes:
+            kwargs["use_indexes"] = self.use_indexes
+        return (self.__class__.__name__, [], kwargs)
+
+    def state_forwards(self, app_label, state):
+        # Statistics live outside of Django's model state
+        pass
+
+    def get_sql(self, schema_editor, model):
+        name = self.statistics_name or path_statistics_name(model, self.name, self.paths)
+        return path_statistics_sql(model, self.name, self.paths, name,
+                                   get_server_version(schema_editor.connection),
+                                   schema_editor.quote_name, self.use_indexes)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        for sql in self.get_sql(schema_editor, model)[0]:
+            schema_editor.execute(sql, params=None)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        for sql in self.get_sql(schema_editor, model)[1]:
+            schema_editor.execute(sql, params=None)
+
+    def describe(self):
+        return "Create statistics on %d json paths of %s.%s" % (len(self.paths), self.model_name,
+                                                               self.name)
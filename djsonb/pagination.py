@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import json
+
+from django.db import connections, router
+from django.db.backends.utils import truncate_name
+
+from .fields import get_encoder_class
+from .lookups import extract_value_at_path, literal_value_at_path
+
+ORDERING_CASTS = ("int", "bigint", "numeric", "float", "text", "date", "timestamp", "timestamptz")
+
+
+def ordering_expression(path, cast):
+    """Produce the typed expression to order by for a path, like intrange_filter traverses it
+
+    `path` starts with the (quoted) column, as the paths of FilterTree rules do
+    """
+    if cast not in ORDERING_CASTS:
+        raise ValueError("djsonb: unsupported ordering cast %r" % (cast,))
+    return "(" + extract_value_at_path(path) + ")::" + cast
+
+
+def keyset_index_sql(model, field_name, path, cast="int", name=None, using=None):
+    """Produce a CREATE INDEX statement matching the ordering used by `keyset_page`
+
+    The statement can be run through a RunSQL migration operation
+    """
+    connection = connections[using or router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    column = opts.get_field(field_name).column
+    if cast not in ORDERING_CASTS:
+        raise ValueError("djsonb: unsupported ordering cast %r" % (cast,))
+    if name is None:
+        digest = hashlib.md5(json.dumps([column] + list(path) + [cast]).encode("utf-8"))
+        name = truncate_name("%s_%s_keyset" % (opts.db_table, digest.hexdigest()[:8]),
+                             connection.ops.max_name_length())
+    expression = "(" + literal_value_at_path([qn(column)] + list(path)) + ")::" + cast
+    return "CREATE INDEX {name} ON {table} (({expression}), {pk})".format(
+        name=qn(name), table=qn(opts.db_table), expression=expression,
+        pk=qn(opts.pk.column))
+
+
+def encode_cursor(value, pk, direction):
+    payload = json.dumps([value, pk, direction], cls=get_encoder_class())
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        value, pk, direction = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (TypeError, ValueError):
+        raise ValueError("djsonb: invalid pagination cursor")
+    if direction not in ("next", "previous"):
+        raise ValueError("djsonb: invalid pagination cursor")
+    return value, pk, direction
+
+
+class KeysetPage(object):
+    """A page of results along with the cursors of its neighbours (None at either end)"""
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def keyset_page(queryset, field_name, path, cast="int", cursor=None, page_size=25,
+                descending=False):
+    """Fetch a page of a queryset ordered by the value at a json path, breaking ties by pk
+
+    Rather than OFFSET, pages are found by seeking past the (value, pk) pair of the row at the
+    edge of the neighbouring page, which an index created by `keyset_index_sql` can answer
+    directly no matter how deep the page is. Rows lacking a value at `path` sort as NULL and
+    can't be seeked past, so they should be filtered out (an intrange rule will do).
+
+    page = keyset_page(Something.objects.filter(data__jsonb=filt), 'data', ['a', 'b'])
+    next_page = keyset_page(Something.objects.filter(data__jsonb=filt), 'data', ['a', 'b'],
+                            cursor=page.next_cursor)
+    """
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    opts = queryset.model._meta
+    path = list(path)
+    table = qn(opts.db_table)
+    expression = ordering_expression([table + "." + qn(opts.get_field(field_name).column)] + path,
+                                     cast)
+
+    direction = "next"
+    extra = {"select": {"_keyset_value": expression}, "select_params": path}
+    if cursor is not None:
+        value, pk, direction = decode_cursor(cursor)
+        seek_forward = (direction == "next") != descending
+        extra["where"] = ["({expression}, {pk}) {op} (%s::{cast}, %s)".format(
+            expression=expression, pk=table + "." + qn(opts.pk.column),
+            op=">" if seek_forward else "<", cast=cast)]
+        extra["params"] = path + [value, pk]
+
+    order_descending = (direction == "previous") != descending
+    prefix = "-" if order_descending else ""
+    extra["order_by"] = [prefix + "_keyset_value", prefix + "pk"]
+
+    rows = list(queryset.extra(**extra)[:page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == "previous":
+        rows.reverse()
+
+    if not rows:
+        return KeysetPage(rows, None, None)
+
+    first, last = rows[0], rows[-1]
+    next_cursor = previous_cursor = None
+    if has_more or direction == "previous":
+        next_cursor = encode_cursor(last._keyset_value, last.pk, "next")
+    if (has_more and direction == "previous") or (cursor is not None and direction == "next"):
+        previous_cursor = encode_cursor(first._keyset_value, first.pk, "previous")
+    return KeysetPage(rows, next_cursor, previous_cursor)
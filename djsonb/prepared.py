@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import collections
+import hashlib
+import re
+import weakref
+
+from django.conf import settings
+from django.db import connections
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+# The statements prepared on each DB-API connection, least recently used first. Keying on the
+# DB-API connection (rather than Django's wrapper) means statements are forgotten along with
+# the server session they were prepared in, however long CONN_MAX_AGE keeps it open
+_prepared_statements = weakref.WeakKeyDictionary()
+
+PLACEHOLDER_RE = re.compile(r"%([s%])")
+
+
+def get_statement_cache_size():
+    return getattr(settings, "DJSONB_PREPARED_STATEMENT_CACHE_SIZE", 100)
+
+
+def statement_name(sql):
+    """Produce a stable name for a SQL template"""
+    return "djsonb_" + hashlib.sha1(sql.encode("utf-8")).hexdigest()[:24]
+
+
+def positional_sql(sql):
+    """Convert a pyformat SQL template (%s placeholders, %% escapes) to $1, $2, ... style"""
+    counter = [0]
+
+    def replace(match):
+        if match.group(1) == "%":
+            return "%"
+        counter[0] += 1
+        return "$%d" % counter[0]
+
+    return PLACEHOLDER_RE.sub(replace, sql)
+
+
+def prepare(connection, sql):
+    """Make sure a SQL template is prepared on a Django connection, returning its name
+
+    Only the DJSONB_PREPARED_STATEMENT_CACHE_SIZE most recently used statements are kept
+    prepared per connection; older ones are deallocated
+    """
+    connection.ensure_connection()
+    statements = _prepared_statements.setdefault(connection.connection,
+                                                 collections.OrderedDict())
+    name = statement_name(sql)
+    if name in statements:
+        # Mark as most recently used
+        statements[name] = statements.pop(name)
+        return name
+
+    with connection.cursor() as cursor:
+        cursor.execute("PREPARE {name} AS {sql}".format(name=name, sql=positional_sql(sql)))
+        statements[name] = True
+        while len(statements) > max(get_statement_cache_size(), 1):
+            stale, _ = statements.popitem(last=False)
+            cursor.execute("DEALLOCATE {name}".format(name=stale))
+    return name
+
+
+def execute_prepared(queryset):
+    """Evaluate a queryset through a server-side prepared statement
+
+    Each distinct SQL template (and so each FilterTree shape) is parsed and planned once per
+    connection, after which only its parameters are sent along. Returns a list of model
+    instances; querysets using select_related or values() aren't supported.
+    """
+    connection = connections[queryset.db]
+    try:
+        sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    except EmptyResultSet:
+        return []
+    name = prepare(connection, sql)
+    if params:
+        execute_sql = "EXECUTE {name} ({placeholders})".format(
+            name=name, placeholders=", ".join(["%s"] * len(params)))
+    else:
+        execute_sql = "EXECUTE {name}".format(name=name)
+    return list(queryset.model._default_manager.db_manager(queryset.db)
+                .raw(execute_sql, params))
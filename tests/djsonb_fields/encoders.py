@@ -1,5 +1,7 @@
 # -*- encoding: utf-8 -*-
 
+import collections
+import json
 import uuid
 
 from django.core.serializers.json import DjangoJSONEncoder
@@ -11,3 +13,7 @@ class CustomJSONEncoder(DjangoJSONEncoder):
         if isinstance(obj, uuid.UUID):
             return obj.hex
         return super(CustomJSONEncoder, self).default(obj)
+
+
+def ordered_loads(value):
+    return json.loads(value, object_pairs_hook=collections.OrderedDict)
@@ -0,0 +1,33 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+import djsonb.fields
+import djsonb.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djsonb_fields', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShadowJsonBModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, verbose_name='ID', serialize=False)),
+                ('data', djsonb.fields.JsonBField(shadow_columns={
+                    'data_status': {'path': ['status'], 'type': 'text'},
+                    'data_priority': {'path': ['meta', 'priority'], 'type': 'int'},
+                })),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        djsonb.operations.AddShadowColumn('ShadowJsonBModel', 'data', 'data_status'),
+        djsonb.operations.AddShadowColumn('ShadowJsonBModel', 'data', 'data_priority'),
+    ]
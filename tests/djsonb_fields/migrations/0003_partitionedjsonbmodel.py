@@ -0,0 +1,30 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+import djsonb.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djsonb_fields', '0002_shadowjsonbmodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PartitionedJsonBModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, verbose_name='ID', serialize=False)),
+                ('tenant', models.CharField(max_length=30)),
+                ('data', djsonb.fields.JsonBField(partition_columns={
+                    'tenant': {'path': ['tenant'], 'type': 'text'},
+                })),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+import djsonb.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djsonb_fields', '0003_partitionedjsonbmodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompactJsonBModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, verbose_name='ID', serialize=False)),
+                ('data', djsonb.fields.JsonBField(compact=True, implicit_defaults={
+                    'status': 'open', 'meta': {'priority': 1},
+                })),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
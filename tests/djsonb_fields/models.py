@@ -1,8 +1,27 @@
 # -*- coding: utf-8 -*-
 
 from django.db import models
+from djsonb.caching import InvalidatingQuerySet
 from djsonb.fields import JsonBField
 
 
 class JsonBModel(models.Model):
     data = JsonBField()
+
+    objects = InvalidatingQuerySet.as_manager()
+
+
+class ShadowJsonBModel(models.Model):
+    data = JsonBField(shadow_columns={
+        'data_status': {'path': ['status'], 'type': 'text'},
+        'data_priority': {'path': ['meta', 'priority'], 'type': 'int'},
+    })
+
+
+class PartitionedJsonBModel(models.Model):
+    tenant = models.CharField(max_length=30)
+    data = JsonBField(partition_columns={'tenant': {'path': ['tenant'], 'type': 'text'}})
+
+
+class CompactJsonBModel(models.Model):
+    data = JsonBField(compact=True, implicit_defaults={'status': 'open', 'meta': {'priority': 1}})
@@ -1,10 +1,29 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals, absolute_import
-from django.test import TestCase
-
-from .models import JsonBModel
-
+import json
+import tempfile
+from collections import OrderedDict
+
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test import TestCase, override_settings
+from django.utils.six import StringIO
+
+from .models import CompactJsonBModel, JsonBModel, PartitionedJsonBModel, ShadowJsonBModel
+
+from djsonb.bulk import bulk_patch
+from djsonb.caching import (InvalidatingManager, cache_stats, cached_count, cached_ids,
+                            get_generation, reset_cache_stats)
+from djsonb.counts import approximate_count, estimate_count
+from djsonb.facets import facet_counts
+from djsonb.fields import (get_server_version, restore_defaults, setup_connection,
+                           strip_document)
+from djsonb.management.commands.djsonb_statistics import filter_path_specs
+from djsonb.operations import path_statistics_sql
+from djsonb.pagination import keyset_index_sql, keyset_page
+from djsonb.prepared import execute_prepared, positional_sql
 from djsonb.lookups import (FilterTree,
                             extract_value_at_path,
                             contains_key_at_path)
@@ -61,6 +80,21 @@ class JsonBFilterTests(TestCase):
                          ('(a @> %s OR a @> %s)',
                           ['{"b": "test1"}', '{"b": "a thing"}']))
 
+    @override_settings(DJSONB_CONTAINMENT_ARRAY_THRESHOLD=1)
+    def test_containment_array_sql(self):
+        self.assertEqual(self.containment_tree.sql(),
+                         ("((data @> ANY(%s::text[]::jsonb[])))",
+                         (['{"a": {"b": {"c": "test1"}}}', '{"a": {"b": {"c": "a thing"}}}'],)))
+
+    def test_large_containment_query(self):
+        JsonBModel.objects.create(data={'a': {'b': [{'c': 1}]}})
+        JsonBModel.objects.create(data={'a': {'b': [{'c': 2000}]}})
+
+        filt = {'a': {'b': {'c': {'_rule_type': 'containment_multiple',
+                                  'contains': list(range(1000, 3000))}}}}
+        query = JsonBModel.objects.filter(data__jsonb=filt)
+        self.assertEqual(query.count(), 1)
+
     def test_containment_query(self):
         JsonBModel.objects.create(data={'a': {'b': {'c': 1}}})
         JsonBModel.objects.create(data={'a': {'b': {'c': 2000}}})
@@ -391,3 +425,561 @@ class JsonBFilterTests(TestCase):
         filt3 = {"Object Details":{"Severity":{"pattern":"fat","_rule_type":"containment"}}}
         query3 = JsonBModel.objects.filter(data__jsonb=filt3)
         self.assertEqual(query3.count(), 1)
+
+
+class JsonBFacetTests(TestCase):
+    def setUp(self):
+        JsonBModel.objects.create(data={'a': {'b': 'zog', 'c': 1}})
+        JsonBModel.objects.create(data={'a': {'b': 'zog', 'c': 2}})
+        JsonBModel.objects.create(data={'a': {'b': 'dog', 'c': 2}})
+
+    def test_facet_counts(self):
+        counts = facet_counts(JsonBModel.objects.all(), 'data', [['a', 'b'], ['a', 'c']])
+        self.assertEqual(counts, {('a', 'b'): [('zog', 2), ('dog', 1)],
+                                  ('a', 'c'): [('2', 2), ('1', 1)]})
+
+    def test_facet_counts_filtered(self):
+        filt = {'a': {'c': {'_rule_type': 'intrange', 'min': 2}}}
+        counts = facet_counts(JsonBModel.objects.filter(data__jsonb=filt), 'data', [['a', 'b']])
+        self.assertEqual(counts, {('a', 'b'): [('dog', 1), ('zog', 1)]})
+
+    def test_facet_counts_limit(self):
+        counts = facet_counts(JsonBModel.objects.all(), 'data', [['a', 'b'], ['a', 'c']], limit=1)
+        self.assertEqual(counts, {('a', 'b'): [('zog', 2)], ('a', 'c'): [('2', 2)]})
+
+    def test_facet_counts_empty_queryset(self):
+        self.assertEqual(facet_counts(JsonBModel.objects.none(), 'data', [['a', 'b']]),
+                         {('a', 'b'): []})
+
+
+class JsonBCountTests(TestCase):
+    def setUp(self):
+        JsonBModel.objects.create(data={'a': {'b': {'c': 1}}})
+        JsonBModel.objects.create(data={'a': {'b': {'c': 2000}}})
+        self.filt = {'a': {'b': {'c': {'_rule_type': 'intrange', 'min': 1, 'max': 5}}}}
+
+    def test_estimate_count(self):
+        query = JsonBModel.objects.filter(data__jsonb=self.filt)
+        self.assertTrue(estimate_count(query) >= 0)
+        self.assertEqual(estimate_count(JsonBModel.objects.filter(pk__in=[])), 0)
+
+    def test_approximate_count_falls_back_to_exact(self):
+        query = JsonBModel.objects.filter(data__jsonb=self.filt)
+        self.assertEqual(approximate_count(query, threshold=10 ** 9), 1)
+
+    def test_approximate_count_uses_estimate(self):
+        query = JsonBModel.objects.filter(data__jsonb=self.filt)
+        self.assertEqual(approximate_count(query, threshold=0), estimate_count(query))
+
+
+class JsonBKeysetPaginationTests(TestCase):
+    def setUp(self):
+        for value in [3, 1, 2, 2, 5]:
+            JsonBModel.objects.create(data={'a': {'b': value}})
+        self.query = JsonBModel.objects.filter(
+            data__jsonb={'a': {'b': {'_rule_type': 'intrange', 'min': 0}}})
+
+    def values(self, page):
+        return [obj.data['a']['b'] for obj in page]
+
+    def test_keyset_pages(self):
+        page1 = keyset_page(self.query, 'data', ['a', 'b'], page_size=2)
+        self.assertEqual(self.values(page1), [1, 2])
+        self.assertEqual(page1.previous_cursor, None)
+
+        page2 = keyset_page(self.query, 'data', ['a', 'b'], cursor=page1.next_cursor, page_size=2)
+        self.assertEqual(self.values(page2), [2, 3])
+
+        page3 = keyset_page(self.query, 'data', ['a', 'b'], cursor=page2.next_cursor, page_size=2)
+        self.assertEqual(self.values(page3), [5])
+        self.assertEqual(page3.next_cursor, None)
+
+        back = keyset_page(self.query, 'data', ['a', 'b'], cursor=page3.previous_cursor,
+                           page_size=2)
+        self.assertEqual([obj.pk for obj in back], [obj.pk for obj in page2])
+        back = keyset_page(self.query, 'data', ['a', 'b'], cursor=back.previous_cursor,
+                           page_size=2)
+        self.assertEqual([obj.pk for obj in back], [obj.pk for obj in page1])
+        self.assertEqual(back.previous_cursor, None)
+
+    def test_keyset_pages_descending(self):
+        page1 = keyset_page(self.query, 'data', ['a', 'b'], page_size=3, descending=True)
+        self.assertEqual(self.values(page1), [5, 3, 2])
+        page2 = keyset_page(self.query, 'data', ['a', 'b'], cursor=page1.next_cursor,
+                            page_size=3, descending=True)
+        self.assertEqual(self.values(page2), [2, 1])
+
+    def test_keyset_index_sql(self):
+        self.assertEqual(keyset_index_sql(JsonBModel, 'data', ['a', 'b'], name='keyset_idx'),
+                         'CREATE INDEX "keyset_idx" ON "djsonb_fields_jsonbmodel" '
+                         '((("data"->\'a\'->>\'b\')::int), "id")')
+        sql = keyset_index_sql(JsonBModel, 'data', ['a', 'b'], using='default')
+        self.assertTrue(sql.startswith('CREATE INDEX "djsonb_fields_jsonbmodel_'))
+        self.assertEqual(sql, keyset_index_sql(JsonBModel, 'data', ['a', 'b']))
+
+
+class JsonBShadowColumnTests(TestCase):
+    def setUp(self):
+        self.shadow_columns = {('status',): ('"data_status"', 'text'),
+                               ('meta', 'priority'): ('"data_priority"', 'int')}
+
+    def test_shadow_containment_sql(self):
+        tree = FilterTree({'status': {'_rule_type': 'containment', 'contains': ['open', 1]}},
+                          'data', shadow_columns=self.shadow_columns)
+        self.assertEqual(tree.sql(), ('(("data_status" = ANY(%s::text[])))', (['open', '1'],)))
+
+    def test_shadow_intrange_sql(self):
+        tree = FilterTree({'meta': {'priority': {'_rule_type': 'intrange', 'min': 1, 'max': 5}}},
+                          'data', shadow_columns=self.shadow_columns)
+        self.assertEqual(tree.sql(), ('(("data_priority" <= %s AND "data_priority" >= %s))',
+                                      (5, 1)))
+
+    def test_shadow_pattern_sql(self):
+        tree = FilterTree({'status': {'_rule_type': 'containment', 'pattern': 'op'}},
+                          'data', shadow_columns=self.shadow_columns)
+        self.assertEqual(tree.sql(), ('(("data_status"::text ~* %s))', ('op',)))
+
+    def test_unshadowed_rules_sql(self):
+        tree = FilterTree({'meta': {'other': {'_rule_type': 'intrange', 'min': 1}}},
+                          'data', shadow_columns=self.shadow_columns)
+        self.assertEqual(tree.sql(), ('(((data->%s->>%s)::int >= %s))', ('meta', 'other', 1)))
+
+    def test_mismatched_shadow_column_sql(self):
+        """Rules which the column's type can't answer keep traversing the json"""
+        tree = FilterTree({'status': {'_rule_type': 'intrange', 'min': 1}},
+                          'data', shadow_columns=self.shadow_columns)
+        self.assertEqual(tree.sql(), ('(((data->>%s)::int >= %s))', ('status', 1)))
+        tree = FilterTree({'meta': {'priority': {'_rule_type': 'containment',
+                                                 'contains': ['abc']}}},
+                          'data', shadow_columns=self.shadow_columns)
+        self.assertEqual(tree.sql(), ('((data @> %s))', ('{"meta": {"priority": "abc"}}',)))
+        ShadowJsonBModel.objects.create(data={'status': '2', 'meta': {'priority': 1}})
+        self.assertEqual(ShadowJsonBModel.objects.filter(data__jsonb={
+            'meta': {'priority': {'_rule_type': 'containment', 'contains': ['abc']}}}).count(), 0)
+        self.assertEqual(ShadowJsonBModel.objects.filter(data__jsonb={
+            'status': {'_rule_type': 'intrange', 'min': 1}}).count(), 1)
+
+    def test_shadow_column_queries(self):
+        ShadowJsonBModel.objects.create(data={'status': 'open', 'meta': {'priority': 1}})
+        ShadowJsonBModel.objects.create(data={'status': 'closed', 'meta': {'priority': 7}})
+        ShadowJsonBModel.objects.create(data={'status': 'opening', 'meta': {'priority': 3}})
+
+        filt1 = {'status': {'_rule_type': 'containment', 'contains': ['open', 'closed']}}
+        self.assertEqual(ShadowJsonBModel.objects.filter(data__jsonb=filt1).count(), 2)
+
+        filt2 = {'meta': {'priority': {'_rule_type': 'intrange', 'min': 2}}}
+        self.assertEqual(ShadowJsonBModel.objects.filter(data__jsonb=filt2).count(), 2)
+
+        filt3 = {'status': {'_rule_type': 'containment', 'pattern': 'open'}}
+        self.assertEqual(ShadowJsonBModel.objects.filter(data__jsonb=filt3).count(), 2)
+
+    def test_shadow_column_follows_updates(self):
+        obj = ShadowJsonBModel.objects.create(data={'status': 'open', 'meta': {'priority': 1}})
+        filt = {'status': {'_rule_type': 'containment', 'contains': ['closed']}}
+        self.assertEqual(ShadowJsonBModel.objects.filter(data__jsonb=filt).count(), 0)
+        obj.data['status'] = 'closed'
+        obj.save()
+        self.assertEqual(ShadowJsonBModel.objects.filter(data__jsonb=filt).count(), 1)
+
+
+class JsonBCachingTests(TestCase):
+    def setUp(self):
+        JsonBModel.objects.create(data={'a': {'b': 1, 'c': 'zog'}})
+        JsonBModel.objects.create(data={'a': {'b': 2000, 'c': 'dog'}})
+        self.filt = {'a': {'b': {'_rule_type': 'intrange', 'min': 1, 'max': 5}}}
+        reset_cache_stats()
+
+    def test_cached_count(self):
+        query = JsonBModel.objects.filter(data__jsonb=self.filt)
+        self.assertEqual(cached_count(query), 1)
+        self.assertEqual(cached_count(JsonBModel.objects.filter(data__jsonb=self.filt)), 1)
+        self.assertEqual(cache_stats(), {'hits': 1, 'misses': 1})
+
+    def test_cached_ids(self):
+        obj = JsonBModel.objects.get(data__jsonb=self.filt)
+        self.assertEqual(cached_ids(JsonBModel.objects.filter(data__jsonb=self.filt)), [obj.pk])
+
+    def test_empty_querysets(self):
+        self.assertEqual(cached_count(JsonBModel.objects.none()), 0)
+        self.assertEqual(cached_ids(JsonBModel.objects.filter(pk__in=[])), [])
+        self.assertEqual(cache_stats(), {'hits': 0, 'misses': 0})
+
+    def test_equivalent_trees_share_results(self):
+        filt1 = {'a': {'b': {'_rule_type': 'intrange', 'min': 1},
+                       'c': {'_rule_type': 'containment', 'contains': ['zog']}}}
+        filt2 = {'a': {'c': {'_rule_type': 'containment', 'contains': ['zog']},
+                       'b': {'_rule_type': 'intrange', 'min': 1}}}
+        self.assertEqual(cached_count(JsonBModel.objects.filter(data__jsonb=filt1)), 1)
+        self.assertEqual(cached_count(JsonBModel.objects.filter(data__jsonb=filt2)), 1)
+        self.assertEqual(cache_stats(), {'hits': 1, 'misses': 1})
+
+    def test_save_invalidates(self):
+        self.assertEqual(cached_count(JsonBModel.objects.filter(data__jsonb=self.filt)), 1)
+        JsonBModel.objects.create(data={'a': {'b': 3}})
+        self.assertEqual(cached_count(JsonBModel.objects.filter(data__jsonb=self.filt)), 2)
+        JsonBModel.objects.filter(data__jsonb=self.filt).first().delete()
+        self.assertEqual(cached_count(JsonBModel.objects.filter(data__jsonb=self.filt)), 1)
+        self.assertEqual(cache_stats(), {'hits': 0, 'misses': 3})
+
+    def test_save_before_cached_reads_invalidates(self):
+        """Receivers are connected when the model is defined, so processes which only write
+        invalidate cached results too"""
+        self.assertTrue(isinstance(JsonBModel.objects, InvalidatingManager))
+        self.assertTrue(post_save.has_listeners(JsonBModel))
+        generation = get_generation(JsonBModel)
+        JsonBModel.objects.create(data={'a': {'b': 3}})
+        self.assertNotEqual(get_generation(JsonBModel), generation)
+
+    def test_update_invalidates(self):
+        self.assertEqual(cached_count(JsonBModel.objects.filter(data__jsonb=self.filt)), 1)
+        JsonBModel.objects.update(data={'a': {'b': 3}})
+        self.assertEqual(cached_count(JsonBModel.objects.filter(data__jsonb=self.filt)), 2)
+
+
+class JsonBPreparedStatementTests(TestCase):
+    def setUp(self):
+        JsonBModel.objects.create(data={'a': {'b': {'c': 1}}})
+        JsonBModel.objects.create(data={'a': {'b': {'c': 2000}}})
+
+    def test_positional_sql(self):
+        self.assertEqual(positional_sql("x->>%s LIKE '%%a' AND y = %s"),
+                         "x->>$1 LIKE '%a' AND y = $2")
+
+    def test_execute_prepared(self):
+        filt = {'a': {'b': {'c': {'_rule_type': 'intrange', 'min': 1, 'max': 5}}}}
+        query = JsonBModel.objects.filter(data__jsonb=filt)
+        self.assertEqual([obj.pk for obj in execute_prepared(query)], [obj.pk for obj in query])
+
+        filt2 = {'a': {'b': {'c': {'_rule_type': 'intrange', 'min': 1, 'max': 2005}}}}
+        self.assertEqual(len(execute_prepared(JsonBModel.objects.filter(data__jsonb=filt2))), 2)
+        self.assertEqual(execute_prepared(JsonBModel.objects.none()), [])
+
+    @override_settings(DJSONB_CONTAINMENT_ARRAY_THRESHOLD=2)
+    def test_execute_prepared_containment_array(self):
+        filt = {'a': {'b': {'c': {'_rule_type': 'containment', 'contains': [1, 2, 3, 4]}}}}
+        query = JsonBModel.objects.filter(data__jsonb=filt)
+        self.assertIn('ANY(', str(query.query))
+        self.assertEqual(len(execute_prepared(query)), 1)
+        self.assertEqual(len(execute_prepared(query)), 1)
+
+    @override_settings(DJSONB_PREPARED_STATEMENT_CACHE_SIZE=1)
+    def test_prepared_statements_are_bounded(self):
+        filt1 = {'a': {'b': {'c': {'_rule_type': 'containment', 'contains': [1]}}}}
+        filt2 = {'a': {'b': {'c': {'_rule_type': 'containment', 'contains': [1, 2000]}}}}
+        self.assertEqual(len(execute_prepared(JsonBModel.objects.filter(data__jsonb=filt1))), 1)
+        self.assertEqual(len(execute_prepared(JsonBModel.objects.filter(data__jsonb=filt2))), 2)
+        self.assertEqual(len(execute_prepared(JsonBModel.objects.filter(data__jsonb=filt1))), 1)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_prepared_statements "
+                           "WHERE name LIKE 'djsonb_%%'")
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class JsonBConnectionSetupTests(TestCase):
+    def tearDown(self):
+        setup_connection(sender=None, connection=connection)
+
+    def test_server_version_is_cached(self):
+        connection.ensure_connection()
+        self.assertEqual(get_server_version(connection), connection.connection.server_version)
+        self.assertEqual(connection._djsonb_server_version, connection.connection.server_version)
+
+    def test_decoder_per_connection(self):
+        JsonBModel.objects.create(data={'a': 1})
+        with override_settings(DJSONB_DECODER_FUNCTIONS={
+                connection.alias: 'djsonb_fields.encoders.ordered_loads'}):
+            setup_connection(sender=None, connection=connection)
+            self.assertTrue(isinstance(JsonBModel.objects.get().data, OrderedDict))
+        setup_connection(sender=None, connection=connection)
+        self.assertFalse(isinstance(JsonBModel.objects.get().data, OrderedDict))
+
+
+class JsonBBulkPatchTests(TestCase):
+    def setUp(self):
+        if get_server_version(connection) < 90500:
+            self.skipTest("jsonb_set requires PostgreSQL >= 9.5")
+        self.obj1 = JsonBModel.objects.create(data={'a': {'b': 1}, 'c': 'zog'})
+        self.obj2 = JsonBModel.objects.create(data={'a': {'b': 2}, 'c': 'dog'})
+
+    def test_bulk_patch_paths(self):
+        updated = bulk_patch(JsonBModel, 'data', [(self.obj1.pk, ['a', 'b'], 10),
+                                                  (self.obj2.pk, ['a', 'd'], {'e': True})])
+        self.assertEqual(updated, 2)
+        self.assertEqual(JsonBModel.objects.get(pk=self.obj1.pk).data,
+                         {'a': {'b': 10}, 'c': 'zog'})
+        self.assertEqual(JsonBModel.objects.get(pk=self.obj2.pk).data,
+                         {'a': {'b': 2, 'd': {'e': True}}, 'c': 'dog'})
+
+    def test_bulk_patch_documents(self):
+        bulk_patch(JsonBModel, 'data', [(self.obj1.pk, {'c': 'frog', 'f': [1]}),
+                                        (self.obj2.pk, {'a': None})])
+        self.assertEqual(JsonBModel.objects.get(pk=self.obj1.pk).data,
+                         {'a': {'b': 1}, 'c': 'frog', 'f': [1]})
+        self.assertEqual(JsonBModel.objects.get(pk=self.obj2.pk).data, {'a': None, 'c': 'dog'})
+
+    def test_bulk_patch_order(self):
+        """Patches to the same row apply in order, even when they're batched together"""
+        bulk_patch(JsonBModel, 'data', [(self.obj1.pk, ['c'], 'one'),
+                                        (self.obj2.pk, ['c'], 'two'),
+                                        (self.obj1.pk, ['c'], 'three'),
+                                        (self.obj1.pk, {'g': 1})], batch_size=2)
+        self.assertEqual(JsonBModel.objects.get(pk=self.obj1.pk).data,
+                         {'a': {'b': 1}, 'c': 'three', 'g': 1})
+        self.assertEqual(JsonBModel.objects.get(pk=self.obj2.pk).data['c'], 'two')
+
+    def test_bulk_patch_invalidates_cache(self):
+        query = JsonBModel.objects.filter(data__jsonb={'c': {'_rule_type': 'containment',
+                                                             'contains': ['zog']}})
+        self.assertEqual(cached_count(query), 1)
+        bulk_patch(JsonBModel, 'data', [(self.obj2.pk, ['c'], 'zog')])
+        self.assertEqual(cached_count(query), 2)
+
+
+class JsonBPartitionColumnTests(TestCase):
+    def setUp(self):
+        self.partition_columns = {('tenant',): ('"tenant"', 'text'),
+                                  ('shard',): ('"shard"', 'int')}
+
+    def test_partition_containment_sql(self):
+        tree = FilterTree({'tenant': {'_rule_type': 'containment', 'contains': ['acme']}},
+                          'data', partition_columns=self.partition_columns)
+        self.assertEqual(tree.sql(), ('((data @> %s) AND ("tenant" = ANY(%s::text[])))',
+                                      ('{"tenant": "acme"}', ['acme'])))
+
+    def test_partition_intrange_sql(self):
+        tree = FilterTree({'shard': {'_rule_type': 'intrange', 'min': 2}},
+                          'data', partition_columns=self.partition_columns)
+        self.assertEqual(tree.sql(), ('(((data->>%s)::int >= %s) AND ("shard" >= %s))',
+                                      ('shard', 2, 2)))
+
+    def test_mismatched_partition_column_sql(self):
+        """Rules which the partition key's type can't answer get no predicate on it"""
+        tree = FilterTree({'tenant': {'_rule_type': 'intrange', 'min': 2}},
+                          'data', partition_columns=self.partition_columns)
+        self.assertEqual(tree.sql(), ('(((data->>%s)::int >= %s))', ('tenant', 2)))
+        tree = FilterTree({'shard': {'_rule_type': 'containment', 'contains': ['abc']}},
+                          'data', partition_columns=self.partition_columns)
+        self.assertEqual(tree.sql(), ('((data @> %s))', ('{"shard": "abc"}',)))
+        PartitionedJsonBModel.objects.create(tenant='7', data={'tenant': '7'})
+        filt = {'tenant': {'_rule_type': 'intrange', 'min': 2}}
+        self.assertEqual(PartitionedJsonBModel.objects.filter(data__jsonb=filt).count(), 1)
+
+    def test_partition_column_queries(self):
+        PartitionedJsonBModel.objects.create(tenant='acme', data={'tenant': 'acme', 'a': 1})
+        PartitionedJsonBModel.objects.create(tenant='initech', data={'tenant': 'initech', 'a': 1})
+        filt = {'tenant': {'_rule_type': 'containment', 'contains': ['acme']}}
+        query = PartitionedJsonBModel.objects.filter(data__jsonb=filt)
+        self.assertEqual([obj.tenant for obj in query], ['acme'])
+
+
+class JsonBPathStatisticsTests(TestCase):
+    def setUp(self):
+        self.specs = [{'path': ['a', 'b'], 'type': 'int'}, {'path': ['c']}]
+
+    def test_path_statistics_sql(self):
+        qn = connection.ops.quote_name
+        self.assertEqual(path_statistics_sql(JsonBModel, 'data', self.specs, 'stats', 140000, qn),
+                         (['CREATE STATISTICS "stats" ON (("data"->\'a\'->>\'b\')::int), '
+                           '("data"->>\'c\') FROM "djsonb_fields_jsonbmodel"',
+                           'ANALYZE "djsonb_fields_jsonbmodel"'],
+                          ['DROP STATISTICS IF EXISTS "stats"']))
+        self.assertEqual(path_statistics_sql(JsonBModel, 'data', self.specs, 'stats', 90400, qn),
+                         ([], []))
+        self.assertEqual(path_statistics_sql(JsonBModel, 'data', self.specs, 'stats', 90400, qn,
+                                             use_indexes=True),
+                         (['CREATE INDEX "stats_0" ON "djsonb_fields_jsonbmodel" '
+                           '((("data"->\'a\'->>\'b\')::int))',
+                           'CREATE INDEX "stats_1" ON "djsonb_fields_jsonbmodel" '
+                           '(("data"->>\'c\'))',
+                           'ANALYZE "djsonb_fields_jsonbmodel"'],
+                          ['DROP INDEX IF EXISTS "stats_0"', 'DROP INDEX IF EXISTS "stats_1"']))
+
+    def test_filter_path_specs(self):
+        filters = [{'a': {'b': {'_rule_type': 'intrange', 'min': 1},
+                          'c': {'_rule_type': 'containment', 'pattern': 'x'},
+                          'd': {'_rule_type': 'containment', 'contains': ['y']}}},
+                   {'a': {'b': {'_rule_type': 'intrange', 'max': 5}}}]
+        self.assertEqual(dict(filter_path_specs(filters)),
+                         {(('a', 'b'), 'int'): 2, (('a', 'c'), 'text'): 1})
+        grouped = [{'_any': [{'a': {'_rule_type': 'intrange', 'min': 1}}]},
+                   {'x': {'_not': {'y': {'_all': [{'z': {'_rule_type': 'containment',
+                                                         'pattern': 'p'}}]}}}}]
+        self.assertEqual(dict(filter_path_specs(grouped)),
+                         {(('a',), 'int'): 1, (('x', 'y', 'z'), 'text'): 1})
+
+    def test_statistics_command(self):
+        # Paths taken from filters aren't cast, so values which aren't integers can't break
+        # the ANALYZE
+        JsonBModel.objects.create(data={'a': {'b': 'abc'}})
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            json.dump([{'a': {'b': {'_rule_type': 'intrange', 'min': 1}}}], f)
+            f.flush()
+            out = StringIO()
+            call_command('djsonb_statistics', 'djsonb_fields.JsonBModel', 'data',
+                         '--path', 'c', '--from-filters', f.name, '--name', 'test_stats',
+                         '--use-indexes', stdout=out)
+            self.assertIn('use --path a.b:int', out.getvalue())
+            self.assertIn('Created statistics test_stats on 2 paths', out.getvalue())
+            out = StringIO()
+            call_command('djsonb_statistics', 'djsonb_fields.JsonBModel', 'data',
+                         '--path', 'a.b', '--from-filters', f.name, '--use-indexes',
+                         '--dry-run', stdout=out)
+            self.assertNotIn('::int', out.getvalue())
+        call_command('djsonb_statistics', 'djsonb_fields.JsonBModel', 'data', '--path', 'c',
+                     '--path', 'a.b:int', '--name', 'test_stats', '--use-indexes', '--drop',
+                     stdout=StringIO())
+
+    def test_statistics_command_index_fallback(self):
+        """Before PostgreSQL 14, expression indexes are only created when asked for"""
+        connection._djsonb_server_version = 90400
+        try:
+            with self.assertRaises(CommandError):
+                call_command('djsonb_statistics', 'djsonb_fields.JsonBModel', 'data',
+                             '--path', 'c', '--dry-run', stdout=StringIO())
+            out = StringIO()
+            call_command('djsonb_statistics', 'djsonb_fields.JsonBModel', 'data', '--path', 'c',
+                         '--use-indexes', '--dry-run', stdout=out)
+        finally:
+            connection._djsonb_server_version = None
+        self.assertTrue(out.getvalue().startswith('CREATE INDEX '))
+
+
+class JsonBProfileCommandTests(TestCase):
+    def test_profile_command(self):
+        JsonBModel.objects.create(data={'a': {'b': 1}, 'c': 'zog'})
+        JsonBModel.objects.create(data={'a': {'b': 'one'}})
+        out = StringIO()
+        call_command('djsonb_profile', 'djsonb_fields.JsonBModel', 'data', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Sampled documents: 2')
+        self.assertTrue(lines[1].startswith('Size in bytes (as stored): '))
+        rows = dict((line.split()[0], line) for line in lines[4:])
+        self.assertTrue(rows['a.b'].endswith('number 1, string 1') or
+                        rows['a.b'].endswith('string 1, number 1'))
+        self.assertEqual(rows['c'].split()[1:4], ['1', '1', '50.0'])
+
+    def test_profile_command_sample(self):
+        """The sizes and the paths are counted over the same sample, on either sampling method"""
+        JsonBModel.objects.bulk_create([JsonBModel(data={'c': i}) for i in range(2000)])
+        # Rows are sampled at random below 9.5 and by block (the table spans over a dozen)
+        # above; neither sample can realistically come up empty at these sizes
+        runs = [(90400, '30')]
+        if get_server_version(connection) >= 90500:
+            runs.append((get_server_version(connection), '90'))
+        for version, sample in runs:
+            connection._djsonb_server_version = version
+            try:
+                out = StringIO()
+                call_command('djsonb_profile', 'djsonb_fields.JsonBModel', 'data',
+                             '--sample', sample, stdout=out)
+            finally:
+                connection._djsonb_server_version = None
+            lines = out.getvalue().splitlines()
+            documents = int(lines[0].split()[-1])
+            self.assertTrue(0 < documents <= 2000)
+            self.assertEqual(lines[4].split()[:4], ['c', '1', str(documents), '100.0'])
+
+
+class JsonBCompactStorageTests(TestCase):
+    def setUp(self):
+        self.defaults = {'status': 'open', 'meta': {'priority': 1}}
+
+    def test_strip_document(self):
+        doc = {'status': 'open', 'meta': {'priority': 1, 'tag': None}, 'x': None,
+               'y': [None, {'z': None}], 'n': 0}
+        self.assertEqual(strip_document(doc, self.defaults), {'y': [None, {}], 'n': 0})
+        self.assertEqual(strip_document(doc, self.defaults, strip_nulls=False),
+                         {'meta': {'tag': None}, 'x': None, 'y': [None, {'z': None}], 'n': 0})
+        self.assertEqual(strip_document({'status': 'closed', 'meta': {'priority': 2}},
+                                        self.defaults),
+                         {'status': 'closed', 'meta': {'priority': 2}})
+        # Only values of the default's own type are stripped, so types survive the round trip
+        defaults = {'enabled': True, 'ratio': 0, 'tags': ['a']}
+        self.assertEqual(strip_document({'enabled': 1, 'ratio': 0.0, 'tags': ['a']}, defaults),
+                         {'enabled': 1, 'ratio': 0.0})
+        self.assertEqual(strip_document({'enabled': True, 'ratio': False}, defaults),
+                         {'ratio': False})
+        # Nulls are kept where a default is declared, so they don't read back as the default
+        doc = {'status': None, 'meta': {'priority': None}, 'x': None}
+        self.assertEqual(strip_document(doc, self.defaults),
+                         {'status': None, 'meta': {'priority': None}})
+        self.assertEqual(restore_defaults(strip_document(doc, self.defaults), self.defaults),
+                         {'status': None, 'meta': {'priority': None}})
+
+    def test_restore_defaults(self):
+        self.assertEqual(restore_defaults({'y': [None]}, self.defaults),
+                         {'status': 'open', 'meta': {'priority': 1}, 'y': [None]})
+        self.assertEqual(restore_defaults({'meta': {'tag': 'a'}}, self.defaults),
+                         {'status': 'open', 'meta': {'priority': 1, 'tag': 'a'}})
+        doc = {'meta': {'tag': 'a'}}
+        restore_defaults(doc, self.defaults)
+        self.assertEqual(doc, {'meta': {'tag': 'a'}})
+
+    def test_compact_storage(self):
+        obj = CompactJsonBModel.objects.create(data={'status': 'open', 'meta': {'priority': 1},
+                                                     'x': None, 'y': 'zog'})
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT data::text FROM djsonb_fields_compactjsonbmodel WHERE id = %s",
+                           [obj.pk])
+            self.assertEqual(json.loads(cursor.fetchone()[0]), {'y': 'zog'})
+        self.assertEqual(CompactJsonBModel.objects.get(pk=obj.pk).data,
+                         {'status': 'open', 'meta': {'priority': 1}, 'y': 'zog'})
+
+    def test_compact_adapter(self):
+        field = CompactJsonBModel._meta.get_field('data')
+        adapted = field.get_db_prep_value({'a': [1, 2], 'b': None}, connection)
+        self.assertEqual(adapted.dumps(adapted.adapted), '{"a":[1,2]}')
+
+
+class JsonBGroupTests(TestCase):
+    def setUp(self):
+        self.status_rule = {'_rule_type': 'containment', 'contains': ['open']}
+        self.priority_rule = {'_rule_type': 'intrange', 'min': 5}
+
+    def test_any_sql(self):
+        tree = FilterTree({'_any': [{'status': self.status_rule},
+                                    {'priority': self.priority_rule}]}, 'data')
+        self.assertEqual(tree.sql(), ('((((data @> %s)) OR (((data->>%s)::int >= %s))))',
+                                      ('{"status": "open"}', 'priority', 5)))
+
+    def test_nested_not_sql(self):
+        tree = FilterTree({'a': {'_not': {'status': self.status_rule},
+                                 'priority': self.priority_rule}}, 'data')
+        self.assertEqual(tree.rules, [(['data', 'a', 'priority'], self.priority_rule)])
+        self.assertEqual(tree.sql(), ('((((data->%s->>%s)::int >= %s)) AND (NOT ((data @> %s))))',
+                                      ('a', 'priority', 5, '{"a": {"status": "open"}}')))
+
+    def test_empty_groups_sql(self):
+        empty_rule = {'_rule_type': 'intrange', 'min': None, 'max': None}
+        tree = FilterTree({'_any': [{'status': self.status_rule}, {'priority': empty_rule}],
+                           '_not': {'priority': empty_rule},
+                           '_all': []}, 'data')
+        self.assertEqual(tree.sql(), ('', ()))
+        # Like an empty OR, an _any of no trees matches nothing
+        tree = FilterTree({'_any': [], 'status': self.status_rule}, 'data')
+        self.assertEqual(tree.sql(), ('(((data @> %s)) AND (FALSE))', ('{"status": "open"}',)))
+        self.assertEqual(JsonBModel.objects.filter(data__jsonb={'_any': []}).count(), 0)
+
+    def test_group_queries(self):
+        JsonBModel.objects.create(data={'status': 'open', 'priority': 1})
+        JsonBModel.objects.create(data={'status': 'closed', 'priority': 7})
+        JsonBModel.objects.create(data={'status': 'closed', 'priority': 2})
+
+        filt1 = {'_any': [{'status': self.status_rule}, {'priority': self.priority_rule}]}
+        self.assertEqual(JsonBModel.objects.filter(data__jsonb=filt1).count(), 2)
+
+        filt2 = {'_not': {'status': self.status_rule},
+                 'priority': {'_rule_type': 'intrange', 'max': 5}}
+        self.assertEqual(JsonBModel.objects.filter(data__jsonb=filt2).count(), 1)
+
+        filt3 = {'_any': [{'_all': [{'status': self.status_rule},
+                                    {'priority': {'_rule_type': 'intrange', 'max': 1}}]},
+                          {'status': {'_rule_type': 'containment', 'pattern': 'clo'},
+                           'priority': self.priority_rule}]}
+        self.assertEqual(JsonBModel.objects.filter(data__jsonb=filt3).count(), 2)
+
+    def test_group_type_errors(self):
+        with self.assertRaises(TypeError):
+            FilterTree({'_any': {'status': self.status_rule}}, 'data').sql()
+        with self.assertRaises(TypeError):
+            FilterTree({'_not': [{'status': self.status_rule}]}, 'data').sql()
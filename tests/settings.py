@@ -35,6 +35,7 @@ STATICFILES_DIRS = ()
 
 SECRET_KEY = 'di!n($kqa3)nd%ikad#kcjpkd^uw*h%*kj=*pm7$vbo6ir7h=l'
 INSTALLED_APPS = (
+    'djsonb',
     'djsonb_fields',
 )
 